@@ -1,21 +1,31 @@
 # api_app.py
 from __future__ import annotations
+import asyncio
 from typing import List, Dict, Any, Optional
 from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 
+import numpy as np
 from fastapi import FastAPI
-from pydantic import BaseModel
+# Новые версии FastAPI помечают ORJSONResponse устаревшим (работает, но с предупреждением);
+# при переходе заменить на собственный Response с orjson.OPT_SERIALIZE_NUMPY
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, conint
 
-from recommendation_service import Recommendations
+from recommendation_service import Recommendations, blend_topk
 
 # Загрузка переменных окружения из .env файла
 load_dotenv()
 
+# Id треков сервис обрабатывает как int64 — значения вне диапазона отклоняем с 422, а не падаем с 500
+TrackId = conint(ge=-2**63, le=2**63 - 1)
+# orjson сериализует только 64-битные целые — user_id ограничиваем тем же диапазоном
+UserId = conint(ge=-2**63, le=2**63 - 1)
+
 class RecommendRequest(BaseModel):
-    user_id: int
-    k: int = 20
-    recent_tracks: Optional[List[int]] = None  # онлайн-история: недавно прослушанные треки
+    user_id: UserId
+    k: conint(ge=1) = 20
+    recent_tracks: Optional[List[TrackId]] = None  # онлайн-история: недавно прослушанные треки
 
 class RecommendResponse(BaseModel):
     user_id: int
@@ -25,9 +35,16 @@ class RecommendResponse(BaseModel):
 async def lifespan(app: FastAPI):
     """Загрузка рекомендаций из S3 при старте приложения"""
     rec = Recommendations()
-    rec.load("final_ranked")
-    rec.load("personal_als")
-    rec.load("top_popular")
+    # Три файла скачиваются и парсятся параллельно: старт ≈ max, а не сумма
+    await asyncio.gather(*(
+        asyncio.to_thread(rec.load, name)
+        for name in ("final_ranked", "personal_als", "top_popular")
+    ))
+    rec.drop_superseded()  # personal_als нужен только пользователям без final_ranked
+    # Компилируем JIT-ядро до приёма запросов (с теми же типами, что в get_with_online),
+    # иначе первая компиляция заблокирует event loop внутри /recommend
+    tiny = np.array([1, 2], dtype=np.int64)
+    await asyncio.to_thread(blend_topk, tiny, tiny[:1], 0.3, 1)
     app.state.rec = rec
     yield
     rec.stats()  # выводим статистику при завершении
@@ -36,16 +53,20 @@ async def lifespan(app: FastAPI):
 app = FastAPI(
     title="Music Recommendations API",
     description="Микросервис рекомендаций с учётом истории пользователя",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,  # orjson сериализует list[int] в разы быстрее json
 )
 
+# Ответ health-проверки не меняется — сериализуем его один раз при импорте
+_HEALTH = ORJSONResponse({"status": "ok"})
+
 @app.get("/health")
-def health() -> Dict[str, Any]:
+async def health() -> ORJSONResponse:
     """Проверка работоспособности сервиса"""
-    return {"status": "ok"}
+    return _HEALTH
 
-@app.post("/recommend", response_model=RecommendResponse)
-def recommend(req: RecommendRequest) -> RecommendResponse:
+@app.post("/recommend", response_class=ORJSONResponse, response_model=RecommendResponse)
+async def recommend(req: RecommendRequest) -> ORJSONResponse:
     """
     Возвращает рекомендации для пользователя.
     
@@ -53,6 +74,8 @@ def recommend(req: RecommendRequest) -> RecommendResponse:
     - Если пользователь новый (нет истории): топ-популярные треки
     - Если переданы recent_tracks: учёт онлайн-истории для улучшения рекомендаций
     """
+    # Поиск рекомендаций — словарь + срез массива (микросекунды),
+    # поэтому выполняем его прямо в event loop без пула потоков
     rec: Recommendations = app.state.rec
     
     if req.recent_tracks:
@@ -67,9 +90,12 @@ def recommend(req: RecommendRequest) -> RecommendResponse:
         # Только офлайн-рекомендации
         tracks = rec.get_offline(user_id=req.user_id, k=req.k)
     
-    return RecommendResponse(user_id=req.user_id, tracks=tracks)
+    # Список треков только что собран сервисом — повторная валидация Pydantic не нужна.
+    # Response возвращается как есть; response_model остаётся для схемы в документации.
+    # tracks — np.ndarray: ORJSONResponse сериализует его с OPT_SERIALIZE_NUMPY без list
+    return ORJSONResponse({"user_id": req.user_id, "tracks": tracks})
 
 @app.get("/stats")
-def get_stats() -> Dict[str, Any]:
+async def get_stats() -> Dict[str, Any]:
     """Статистика использования рекомендаций"""
-    return app.state.rec._stats
+    return app.state.rec.stats_snapshot()
@@ -1,14 +1,16 @@
 # recommendation_service.py
+import itertools
 import os
+import threading
 from dotenv import load_dotenv
-import io
 import logging as logger
 from typing import Dict, List, Optional
 import numpy as np
+from numba import njit
 
-import boto3
-from botocore.client import Config
 import pandas as pd
+import pyarrow.parquet as pq
+from pyarrow import fs as pafs
 
 S3_KEYS: Dict[str, str] = {
     "top_popular":  "recsys/recommendations/top_popular.parquet",      # ['track_id','rank','listen_count']
@@ -16,6 +18,78 @@ S3_KEYS: Dict[str, str] = {
     "final_ranked": "recsys/recommendations/recommendations.parquet",  # ['user_id','track_id','score','rank']
 }
 
+# Колонки, которые реально используются сервисом (остальные не читаем из parquet)
+S3_COLUMNS: Dict[str, List[str]] = {
+    "top_popular":  ["track_id", "rank", "listen_count"],
+    "personal_als": ["user_id", "track_id", "score", "rank"],
+    "final_ranked": ["user_id", "track_id", "score", "rank"],
+}
+
+def _compact_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Компактные типы колонок: примерно вдвое меньше памяти, чем int64/float64 по умолчанию.
+    Вызывать после сортировки — во float32 близкие score склеиваются в равные.
+    """
+    for col in ("track_id", "rank"):
+        if col in df.columns:
+            # Минимальный целый тип, вмещающий все значения: id не переполняются
+            df[col] = pd.to_numeric(df[col], downcast="integer")
+    if "score" in df.columns:
+        df["score"] = df["score"].astype("float32", copy=False)
+    return df
+
+def _split_by_user(users: np.ndarray, tracks: np.ndarray) -> Dict[int, np.ndarray]:
+    """Разбивает отсортированные по user_id треки на срезы-представления по пользователям"""
+    if len(users) == 0:
+        return {}
+    # Срезы отдаются наружу как есть — запрещаем запись в общий буфер
+    tracks.flags.writeable = False
+    starts = np.flatnonzero(np.r_[True, users[1:] != users[:-1]])
+    return dict(zip(users[starts].tolist(), np.split(tracks, starts[1:])))
+
+@njit(cache=True)
+def blend_topk(cands: np.ndarray, recent: np.ndarray, alpha: float, k: int) -> np.ndarray:
+    """
+    Индексы top-K кандидатов по score = (1-alpha)/(i+1) + alpha*[cands[i] in recent].
+    Внутри каждой группы (с бустом / без) оценка убывает с позицией, поэтому
+    top-K — это слияние двух уже упорядоченных списков за один проход, без сортировки.
+    """
+    n = cands.shape[0]
+    recent_set = set(recent)
+    boosted = np.empty(n, dtype=np.int64)
+    plain = np.empty(n, dtype=np.int64)
+    n_boosted = 0
+    n_plain = 0
+    for i in range(n):
+        if cands[i] in recent_set:
+            boosted[n_boosted] = i
+            n_boosted += 1
+        else:
+            plain[n_plain] = i
+            n_plain += 1
+
+    m = max(min(k, n), 0)  # k <= 0 — пустой результат, а не отрицательный размер
+    out = np.empty(m, dtype=np.int64)
+    bi = 0
+    pi = 0
+    for j in range(m):
+        if bi < n_boosted and pi < n_plain:
+            b = boosted[bi]
+            p = plain[pi]
+            score_b = (1.0 - alpha) / (b + 1) + alpha
+            score_p = (1.0 - alpha) / (p + 1)
+            # При равенстве оценок выше тот, кто раньше в офлайн-списке
+            take_boosted = score_b > score_p or (score_b == score_p and b < p)
+        else:
+            take_boosted = bi < n_boosted
+        if take_boosted:
+            out[j] = boosted[bi]
+            bi += 1
+        else:
+            out[j] = plain[pi]
+            pi += 1
+    return out
+
 def _require_env(*names: str) -> None:
     missing = [n for n in names if not os.getenv(n)]
     if missing:
@@ -24,43 +98,102 @@ def _require_env(*names: str) -> None:
 # Загрузка переменных окружения из .env файла
 load_dotenv()
 
-def make_s3_client():
+# Одна файловая система S3 на процесс: пул соединений AWS SDK переиспользуется
+# всеми загрузками (и тестами), TLS/TCP-рукопожатие не повторяется
+_S3_FS: Optional[pafs.S3FileSystem] = None
+_S3_FS_LOCK = threading.Lock()
+
+def make_s3_filesystem() -> pafs.S3FileSystem:
     _require_env("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "student_s3_bucket")
-    return boto3.client(
-        "s3",
-        aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-        aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-        endpoint_url="https://storage.yandexcloud.net",
-        config=Config(signature_version="s3v4", s3={"payload_signing_enabled": False}),
+    return pafs.S3FileSystem(
+        access_key=os.getenv("AWS_ACCESS_KEY_ID"),
+        secret_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+        endpoint_override="https://storage.yandexcloud.net",
+        retry_strategy=pafs.AwsStandardS3RetryStrategy(max_attempts=5),
+        connect_timeout=5,
+        request_timeout=60,
     )
 
-def read_parquet_s3(s3_client, bucket: str, key: str, **kwargs) -> pd.DataFrame:
-    obj = s3_client.get_object(Bucket=bucket, Key=key)
-    buf = io.BytesIO(obj["Body"].read())
-    return pd.read_parquet(buf, **kwargs)  # pyarrow/fastparquet [web:200]
+def get_s3_filesystem() -> pafs.S3FileSystem:
+    """Общий для всего процесса клиент S3 (создаётся при первом обращении)"""
+    global _S3_FS
+    with _S3_FS_LOCK:
+        if _S3_FS is None:
+            _S3_FS = make_s3_filesystem()
+        return _S3_FS
+
+def read_parquet_s3(s3_fs: pafs.S3FileSystem, bucket: str, key: str, **kwargs) -> pd.DataFrame:
+    # Читаем потоком через pyarrow: только нужные колонки и без промежуточного bytes-буфера
+    table = pq.read_table(f"{bucket}/{key}", filesystem=s3_fs, **kwargs)
+    return table.to_pandas(self_destruct=True, zero_copy_only=False)
 
 class Recommendations:
     def __init__(self):
-        self._recs = {"final_ranked": None, "personal_als": None, "top_popular": None}
+        # user_id -> массив track_id (уже упорядоченный), строится в load()
+        self._recs_idx: Dict[str, Dict[int, np.ndarray]] = {"final_ranked": {}, "personal_als": {}}
+        # top_popular, уже упорядоченный; None — ещё не загружен
+        self._top_list: Optional[np.ndarray] = None
+        # Счётчики-итераторы: next() — атомарный инкремент без перезаписи значения в словаре
         self._stats = {
-            "request_personal_count": 0,     # пользователи с историей
-            "request_default_count": 0,      # пользователи без истории
-            "request_with_online_count": 0,  # запросы с онлайн-сигналами
+            "request_personal_count": itertools.count(),     # пользователи с историей
+            "request_default_count": itertools.count(),      # пользователи без истории
+            "request_with_online_count": itertools.count(),  # запросы с онлайн-сигналами
         }
-        self._s3 = make_s3_client()
+        # Сколько раз каждый счётчик читался в stats_snapshot. Инвариант:
+        # значение счётчика = next(counter) - _stats_reads[name], поэтому вне горячего
+        # пути next() для счётчиков вызывает только stats_snapshot (и он же ведёт _stats_reads)
+        self._stats_reads = dict.fromkeys(self._stats, 0)
+        self._lock = threading.Lock()  # load() можно вызывать из нескольких потоков
+        self._s3 = get_s3_filesystem()
         self._bucket = os.getenv("student_s3_bucket")
 
     def load(self, rtype: str, **kwargs):
-        """Загружает один из типов рекомендаций из S3"""
+        """Загружает один из типов рекомендаций из S3 (потокобезопасно)"""
         if rtype not in S3_KEYS:
             raise ValueError(f"rtype must be in {list(S3_KEYS.keys())}")
         key = S3_KEYS[rtype]
         logger.info(f"Loading '{rtype}' from s3://{self._bucket}/{key}")
+        kwargs.setdefault("columns", S3_COLUMNS[rtype])
         df = read_parquet_s3(self._s3, self._bucket, key, **kwargs)
-        if rtype in {"final_ranked", "personal_als"} and "user_id" in df.columns:
-            df = df.set_index("user_id")
-        self._recs[rtype] = df
-        logger.info(f"Loaded '{rtype}' with {len(df)} rows")
+        # Сортируем один раз при загрузке, чтобы не сортировать на каждый запрос
+        if rtype == "top_popular":
+            # Порядок не меняется между загрузками — сортируем только здесь.
+            # Храним только массив track_id: rank/listen_count после сортировки не нужны
+            top = _compact_dtypes(self._order_top(df))["track_id"].to_numpy(copy=True)
+            top.flags.writeable = False
+            with self._lock:
+                self._top_list = top
+            logger.info(f"Loaded '{rtype}' with {len(top)} rows")
+            return
+        # Персональные: score↓ → rank↑ внутри пользователя; стабильная сортировка
+        # индекса сохраняет этот порядок и делает группы непрерывными
+        df = _compact_dtypes(self._order_personal(df)).set_index("user_id").sort_index(kind="stable")
+        idx = _split_by_user(df.index.to_numpy(), df["track_id"].to_numpy())
+        # Загрузки идут параллельно — публикуем результат под блокировкой
+        with self._lock:
+            self._recs_idx[rtype] = idx
+        # Сам DataFrame больше не нужен: запросы обслуживаются из словаря
+        logger.info(f"Loaded '{rtype}' with {len(df)} rows for {len(idx)} users")
+
+    def drop_superseded(self) -> None:
+        """
+        Убирает из personal_als пользователей, которые есть в final_ranked:
+        для них personal_als никогда не используется в get_offline.
+        Вызывается после загрузки обоих типов.
+        """
+        with self._lock:
+            fr_users = self._recs_idx["final_ranked"]
+            pa = {u: v for u, v in self._recs_idx["personal_als"].items() if u not in fr_users}
+            if pa:
+                # Срезы ссылаются на общий буфер — переупаковываем, чтобы освободить память
+                lengths = np.fromiter((len(v) for v in pa.values()), dtype=np.int64, count=len(pa))
+                buf = np.concatenate(list(pa.values()))
+                buf.flags.writeable = False
+                packed = np.split(buf, np.cumsum(lengths)[:-1])
+                pa = dict(zip(pa.keys(), packed))
+            dropped = len(self._recs_idx["personal_als"]) - len(pa)
+            self._recs_idx["personal_als"] = pa
+        logger.info(f"personal_als: dropped {dropped} users superseded by final_ranked")
 
     def _order_personal(self, df: pd.DataFrame) -> pd.DataFrame:
         """Сортировка персональных рекомендаций: score↓ → rank↑"""
@@ -82,53 +215,39 @@ class Recommendations:
             return df.sort_values("rank", ascending=True)
         return df
 
-    def get_offline(self, user_id: int, k: int = 100) -> List[int]:
+    def get_offline(self, user_id: int, k: int = 100) -> np.ndarray:
         """
         Возвращает офлайн-рекомендации для пользователя.
         Приоритет: final_ranked → personal_als → top_popular (для новых пользователей).
         Это учитывает всю историю пользователя, собранную на этапе офлайн-обучения.
+        Результат — срез-представление массива track_id (без копирования в list):
+        ORJSONResponse сериализует его напрямую. Массивы доступны только для чтения.
         """
         # 1) Финально ранжированные персональные (учитывают всю историю)
-        fr = self._recs["final_ranked"]
-        if fr is not None:
-            try:
-                recs = fr.loc[user_id]
-                if isinstance(recs, pd.Series):
-                    recs = recs.to_frame().T
-                recs = self._order_personal(recs)
-                tracks = recs["track_id"].head(k).tolist()
-                self._stats["request_personal_count"] += 1
-                logger.info(f"User {user_id}: returned {len(tracks)} tracks from final_ranked")
-                return tracks
-            except KeyError:
-                pass
+        arr = self._recs_idx["final_ranked"].get(user_id)
+        if arr is not None:
+            tracks = arr[:k]
+            next(self._stats["request_personal_count"])
+            logger.info(f"User {user_id}: returned {len(tracks)} tracks from final_ranked")
+            return tracks
 
         # 2) Персональные ALS (учитывают историю для collaborative filtering)
-        pa = self._recs["personal_als"]
-        if pa is not None:
-            try:
-                recs = pa.loc[user_id]
-                if isinstance(recs, pd.Series):
-                    recs = recs.to_frame().T
-                recs = self._order_personal(recs)
-                tracks = recs["track_id"].head(k).tolist()
-                self._stats["request_personal_count"] += 1
-                logger.info(f"User {user_id}: returned {len(tracks)} tracks from personal_als")
-                return tracks
-            except KeyError:
-                pass
+        arr = self._recs_idx["personal_als"].get(user_id)
+        if arr is not None:
+            tracks = arr[:k]
+            next(self._stats["request_personal_count"])
+            logger.info(f"User {user_id}: returned {len(tracks)} tracks from personal_als")
+            return tracks
 
         # 3) Топ-популярные (для пользователей без истории)
-        tp = self._recs["top_popular"]
-        if tp is not None:
-            recs = self._order_top(tp)
-            tracks = recs["track_id"].head(k).tolist()
-            self._stats["request_default_count"] += 1
+        if self._top_list is not None:
+            tracks = self._top_list[:k]
+            next(self._stats["request_default_count"])
             logger.info(f"User {user_id}: no history, returned {len(tracks)} tracks from top_popular")
             return tracks
 
         logger.error("No recommendations available")
-        return []
+        return np.empty(0, dtype=np.int32)
 
     def get_with_online(
         self, 
@@ -136,7 +255,7 @@ class Recommendations:
         k: int = 100, 
         recent_tracks: Optional[List[int]] = None,
         alpha: float = 0.3
-    ) -> List[int]:
+    ) -> np.ndarray:
         """
         Возвращает рекомендации с учетом онлайн-истории (недавно прослушанные треки).
         Смешивает офлайн-оценки с онлайн-сигналом (популярность недавних треков).
@@ -150,45 +269,49 @@ class Recommendations:
         """
         # Получаем офлайн-кандидаты (расширенный список для последующей фильтрации)
         offline = self.get_offline(user_id, k=k*5)
-        if not offline:
-            return []
+        if len(offline) == 0:
+            return offline
 
         # Если нет онлайн-истории или пользователь новый, возвращаем офлайн
         if not recent_tracks:
             return offline[:k]
 
-        self._stats["request_with_online_count"] += 1
+        next(self._stats["request_with_online_count"])
+
+        # Ни один недавний трек не попал в кандидаты — буст нулевой,
+        # и смешивание вернёт ровно офлайн-порядок
+        recent_set = set(recent_tracks)
+        recent_arr = np.fromiter(recent_set, dtype=np.int64, count=len(recent_set))
+        if not np.isin(offline, recent_arr).any():
+            return offline[:k]
+
+        # Кандидаты как int64 — тот же тип, что у недавних треков в JIT-ядре
+        tracks_arr = offline.astype(np.int64)
 
-        # Формируем DataFrame кандидатов
-        cands_df = pd.DataFrame({"track_id": offline})
-        
         # Простой онлайн-сигнал: бустим треки, похожие на недавние
-        # (в реальности здесь можно использовать embeddings, жанры, исполнителей и т.п.)
-        cands_df["online_boost"] = cands_df["track_id"].apply(
-            lambda tid: 1.0 if tid in recent_tracks else 0.0
-        )
-        
-        # Нормализуем: офлайн-позиция (чем раньше в списке, тем выше оценка)
-        cands_df["offline_score"] = 1.0 / (cands_df.index + 1)
-        
-        # Смешиваем оценки
-        cands_df["final_score"] = (
-            (1 - alpha) * cands_df["offline_score"] + 
-            alpha * cands_df["online_boost"]
-        )
-        
-        # Сортируем и берём top-K
-        cands_df = cands_df.sort_values("final_score", ascending=False)
-        result = cands_df["track_id"].head(k).tolist()
-        
+        # (в реальности здесь можно использовать embeddings, жанры, исполнителей и т.п.).
+        # Офлайн-оценка — 1/позиция; смешивание и отбор top-K в JIT-ядре
+        top_idx = blend_topk(tracks_arr, recent_arr, alpha, k)
+        result = tracks_arr[top_idx]
+
         logger.info(
             f"User {user_id}: blended offline+online, "
             f"recent_tracks={len(recent_tracks)}, returned {len(result)} tracks"
         )
         return result
 
+    def stats_snapshot(self) -> Dict[str, int]:
+        """Текущие значения счётчиков запросов"""
+        with self._lock:
+            snapshot = {}
+            for name, counter in self._stats.items():
+                # next() возвращает число инкрементов плюс число предыдущих чтений
+                snapshot[name] = next(counter) - self._stats_reads[name]
+                self._stats_reads[name] += 1
+            return snapshot
+
     def stats(self):
         """Выводит статистику по типам запросов"""
         logger.info("=== Recommendation Stats ===")
-        for name, value in self._stats.items():
+        for name, value in self.stats_snapshot().items():
             logger.info(f"{name:<30} {value}")
@@ -1,14 +1,13 @@
 # test_service.py
 import os
 from dotenv import load_dotenv
-import io
 import json
 from fastapi.testclient import TestClient
-import pandas as pd
-import boto3
-from botocore.client import Config
+import numpy as np
+import pyarrow.parquet as pq
 
 from api_app import app
+from recommendation_service import blend_topk, get_s3_filesystem
 
 LOG_PATH = "test_service.log"
 FINAL_KEY = "recsys/recommendations/recommendations.parquet"
@@ -16,28 +15,40 @@ FINAL_KEY = "recsys/recommendations/recommendations.parquet"
 # Загрузка переменных окружения из .env файла
 load_dotenv()
 
-def _s3():
-    return boto3.client(
-        "s3",
-        aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-        aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-        endpoint_url="https://storage.yandexcloud.net",
-        config=Config(signature_version="s3v4", s3={"payload_signing_enabled": False}),
-    )
-
-def _read_parquet(bucket: str, key: str) -> pd.DataFrame:
-    s3 = _s3()
-    obj = s3.get_object(Bucket=bucket, Key=key)
-    return pd.read_parquet(io.BytesIO(obj["Body"].read()))
+def _check_blend_topk(n_cases: int = 3000) -> int:
+    """Сверяет JIT-ядро blend_topk с полной стабильной сортировкой смешанной оценки"""
+    rng = np.random.default_rng(42)
+    for _ in range(n_cases):
+        n = int(rng.integers(1, 60))
+        k = int(rng.integers(1, 30))
+        cands = rng.permutation(200)[:n].astype(np.int64)
+        recent = rng.integers(0, 200, size=int(rng.integers(1, 10))).astype(np.int64)
+        # Крайние alpha дают много равных оценок — проверяем порядок при равенстве
+        alpha = float(rng.choice([0.0, 0.3, 0.5, 1.0, rng.random()]))
+        score = (1 - alpha) / np.arange(1, n + 1) + alpha * np.isin(cands, recent)
+        expected = np.argsort(-score, kind="stable")[:k]
+        got = blend_topk(cands, recent, alpha, k)
+        assert np.array_equal(got, expected), (cands, recent, alpha, k, got, expected)
+    # k <= 0 — пустой результат без ошибки
+    cands = np.arange(10, dtype=np.int64)
+    for k in (0, -1):
+        assert len(blend_topk(cands, cands[:3], 0.3, k)) == 0, k
+    return n_cases
 
 def _pick_known_user() -> int:
+    # Нужен любой известный пользователь: читаем только user_id из первой row group,
+    # файл открывается с произвольным доступом (HTTP Range), а не скачивается целиком
     bucket = os.getenv("student_s3_bucket")
-    df = _read_parquet(bucket, FINAL_KEY)
-    return int(df["user_id"].iloc[0])
+    with get_s3_filesystem().open_input_file(f"{bucket}/{FINAL_KEY}") as f:
+        row_group = pq.ParquetFile(f).read_row_group(0, columns=["user_id"])
+    return int(row_group.column("user_id")[0].as_py())
 
 def _pick_unknown_user(known: int) -> int:
     return known + 99_999_999
 
+# Офлайн-проверка JIT-ядра: не требует S3, выполняется до запуска сервиса
+n_blend_cases = _check_blend_topk()
+
 with TestClient(app) as client, open(LOG_PATH, "w", encoding="utf-8") as fout:
     fout.write("=== Тестирование сервиса рекомендаций ===\n\n")
     
@@ -96,4 +107,7 @@ with TestClient(app) as client, open(LOG_PATH, "w", encoding="utf-8") as fout:
     fout.write("4. Статистика работы сервиса:\n")
     fout.write(f"   {json.dumps(r.json(), indent=2, ensure_ascii=False)}\n\n")
 
+    # 5) JIT-ядро смешивания совпадает с эталонной сортировкой
+    fout.write(f"5. blend_topk: {n_blend_cases} случаев совпали с np.argsort(-score, kind='stable')[:k]\n\n")
+
     fout.write("=== Все тесты пройдены успешно ===\n")